@@ -6,14 +6,32 @@ Flask Web服务：Markdown to EPUB 转换器
 
 import os
 import io
-import uuid
+import time
+import glob
 import shutil
+import zipfile
+import hashlib
+import multiprocessing
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
 
 from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
+from ebooklib import epub
+
+try:
+    import cmarkgfm
+    from cmarkgfm.cmark import Options as CmarkOptions
+except ImportError:
+    cmarkgfm = None
 
 from md2ebook import MarkdownEbookConverter
 
@@ -27,6 +45,20 @@ UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'output'
 ALLOWED_EXTENSIONS = {'md', 'markdown', 'txt'}
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_SUFFIXES = tuple(f'.{ext}' for ext in ALLOWED_EXTENSIONS)
+ALLOWED_IMAGE_SUFFIXES = tuple(f'.{ext}' for ext in ALLOWED_IMAGE_EXTENSIONS)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 上传文件按1MB分块写入磁盘
+CLEANUP_INTERVAL = 600  # 后台清理临时文件的间隔（秒）
+EPUB_CACHE_TTL = 600  # 生成的EPUB在内存中保留的时间（秒）
+EPUB_CACHE_SIZE = 32
+EPUB_WORKERS = int(os.environ.get('EPUB_WORKERS', 2))  # 每个Web进程中生成EPUB的进程数
+CONVERT_TIMEOUT = 60  # 生成EPUB的超时时间（秒）
+
+# 新文件的权限：mkstemp固定创建0600的文件，改回与open()相同的受umask约束的权限，
+# 以便nginx等其他用户的进程通过X-Accel-Redirect读取output中的文件
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
 
 # 确保目录存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -36,37 +68,313 @@ os.makedirs('templates', exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+# Markdown解析器：cmark（C实现，默认）或 markdown（Python-Markdown，兼容extra等扩展）
+app.config['MARKDOWN_PARSER'] = os.environ.get('MARKDOWN_PARSER', 'cmark')
+# nginx内部location前缀（如 /protected/），设置后下载由nginx通过X-Accel-Redirect发送
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+
+# 解析结果缓存（按内容哈希，LRU淘汰）：key -> (结果, 按字符数估算的大小)
+MD_CACHE_SIZE = 128
+MD_CACHE_MAX_CHARS = 32 * 1024 * 1024  # 缓存内容的总字符数上限
+MD_CACHE_ITEM_MAX_CHARS = 4 * 1024 * 1024  # 超过该字符数的结果不缓存
+_MD_CACHE = OrderedDict()
+_md_cache_chars = 0
+_MD_CACHE_LOCK = threading.Lock()
+
+# Web版EPUB样式表（预先编码为字节，每本书复用；与md2ebook.EPUB_STYLE不同）
+WEB_EPUB_STYLE = '''
+body {
+    font-family: "Microsoft YaHei", "SimSun", serif;
+    line-height: 1.6;
+    margin: 2em;
+}
+h1, h2, h3, h4, h5, h6 {
+    color: #333;
+    margin-top: 1.5em;
+    margin-bottom: 0.5em;
+}
+h1 {
+    font-size: 1.8em;
+    border-bottom: 2px solid #333;
+    padding-bottom: 0.3em;
+}
+h2 {
+    font-size: 1.5em;
+    color: #666;
+}
+h3 {
+    font-size: 1.3em;
+}
+p {
+    margin-bottom: 1em;
+    text-align: justify;
+}
+ul, ol {
+    margin-left: 2em;
+}
+li {
+    margin-bottom: 0.5em;
+}
+strong {
+    font-weight: bold;
+    color: #d73502;
+}
+code {
+    background-color: #f4f4f4;
+    padding: 2px 4px;
+    border-radius: 3px;
+    font-family: "Courier New", monospace;
+}
+pre {
+    background-color: #f8f8f8;
+    padding: 1em;
+    border-radius: 5px;
+    overflow-x: auto;
+}
+blockquote {
+    border-left: 4px solid #ddd;
+    margin-left: 0;
+    padding-left: 1em;
+    color: #666;
+}
+'''
+WEB_EPUB_STYLE_BYTES = WEB_EPUB_STYLE.encode('utf-8')
+
+# 已生成的EPUB：download_id -> (文件路径, 下载文件名)（多进程部署时未命中则回退到glob查找）
+_DOWNLOAD_MAP = {}
+
+# 刚生成的EPUB内容：download_id -> (生成时间, 字节数据, ETag)，下载时免去读盘
+_EPUB_CACHE = OrderedDict()
+_EPUB_CACHE_LOCK = threading.Lock()
+
+# 后台清理线程（按进程启动，记录启动它的进程号）
+_cleanup_thread = None
+_cleanup_pid = None
+_cleanup_lock = threading.Lock()
+
+# 生成EPUB的进程池（首次转换时创建，避免在gunicorn等预加载场景下跨fork继承）
+_epub_pool = None
+_epub_pool_lock = threading.Lock()
+
+
+def allowed_file(filename, allowed_suffixes):
+    """检查文件扩展名是否允许（allowed_suffixes为带点的小写后缀元组）"""
+    return filename.lower().endswith(allowed_suffixes)
+
+
+def save_upload(file, filepath):
+    """按固定大小分块把上传文件写入磁盘（比FileStorage.save默认的16KB缓冲更少系统调用）"""
+    with open_atomic(filepath) as out:
+        shutil.copyfileobj(file.stream, out, UPLOAD_CHUNK_SIZE)
+
+
+def upload_id(stream):
+    """按内容计算上传文件的ID（blake2b摘要），相同文件得到相同ID"""
+    hasher = hashlib.blake2b(digest_size=12)
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+@contextmanager
+def open_atomic(filepath):
+    """打开临时文件供写入，写完后改名为目标文件，避免并发请求读到写了一半的文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(fd, FILE_MODE)
+            yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_file_atomic(filepath, data):
+    """先写临时文件再改名，避免并发请求读到写了一半的文件"""
+    with open_atomic(filepath) as f:
+        f.write(data)
+
+
+def markdown_parser():
+    """当前实际使用的Markdown解析器名称（未安装cmarkgfm时回退到markdown）"""
+    if cmarkgfm is not None and app.config['MARKDOWN_PARSER'] == 'cmark':
+        return 'cmark'
+    return 'markdown'
+
+
+def content_key(kind, text):
+    """计算缓存键：类型前缀 + 内容的blake2b摘要"""
+    return kind + hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
 
+def cache_get(key):
+    """读取解析缓存，命中时移动到队尾"""
+    with _MD_CACHE_LOCK:
+        entry = _MD_CACHE.get(key)
+        if entry is None:
+            return None
+        _MD_CACHE.move_to_end(key)
+        return entry[0]
 
-def allowed_file(filename, allowed_extensions):
-    """检查文件扩展名是否允许"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+
+def cache_put(key, value, size):
+    """写入解析缓存，条目数或总字符数超出上限时淘汰最旧的条目
+    
+    Args:
+        key (bytes): 缓存键
+        value: 解析结果
+        size (int): 结果的大小（字符数），过大的结果不缓存
+        
+    Returns:
+        传入的value
+    """
+    global _md_cache_chars
+    if size > MD_CACHE_ITEM_MAX_CHARS:
+        return value
+    with _MD_CACHE_LOCK:
+        old = _MD_CACHE.pop(key, None)
+        if old is not None:
+            _md_cache_chars -= old[1]
+        _MD_CACHE[key] = (value, size)
+        _md_cache_chars += size
+        while len(_MD_CACHE) > MD_CACHE_SIZE or _md_cache_chars > MD_CACHE_MAX_CHARS:
+            _md_cache_chars -= _MD_CACHE.popitem(last=False)[1][1]
+    return value
+
+
+def remember_epub(download_id, data):
+    """缓存刚生成的EPUB内容，超出容量时淘汰最旧的条目
+    
+    同一个download_id可能先后对应不同的内容（如封面过期时生成的无封面版本），
+    所以ETag取文件内容的摘要，而不是download_id
+    """
+    etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+    with _EPUB_CACHE_LOCK:
+        _EPUB_CACHE[download_id] = (time.time(), data, etag)
+        # 重新生成的ID移到队尾，保证队列按生成时间排序（过期清理和淘汰都从队首开始）
+        _EPUB_CACHE.move_to_end(download_id)
+        while len(_EPUB_CACHE) > EPUB_CACHE_SIZE:
+            _EPUB_CACHE.popitem(last=False)
+
+
+def get_cached_epub(download_id):
+    """读取缓存的EPUB内容，返回(字节数据, ETag)，未命中或已过期返回None"""
+    with _EPUB_CACHE_LOCK:
+        entry = _EPUB_CACHE.get(download_id)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > EPUB_CACHE_TTL:
+            del _EPUB_CACHE[download_id]
+            return None
+        return entry[1:]
+
+
+def reap_epub_cache():
+    """清除过期的EPUB缓存"""
+    expire_before = time.time() - EPUB_CACHE_TTL
+    with _EPUB_CACHE_LOCK:
+        while _EPUB_CACHE and next(iter(_EPUB_CACHE.values()))[0] < expire_before:
+            _EPUB_CACHE.popitem(last=False)
+
+
+def get_epub_pool():
+    """获取生成EPUB的进程池
+    
+    子进程用spawn方式启动：进程池在已有多个请求线程的进程中创建，fork只复制当前线程，
+    其他线程当时持有的锁（缓存锁、日志锁等）在子进程中会一直处于加锁状态
+    """
+    global _epub_pool
+    with _epub_pool_lock:
+        if _epub_pool is None:
+            _epub_pool = ProcessPoolExecutor(max_workers=EPUB_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return _epub_pool
+
+
+def discard_epub_pool(pool):
+    """丢弃已损坏的进程池（子进程被杀死等），下次使用时重新创建"""
+    global _epub_pool
+    with _epub_pool_lock:
+        if _epub_pool is pool:
+            _epub_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_epub_pool(fn, *args):
+    """在进程池中执行任务并等待结果，进程池损坏时重建后重试一次"""
+    for attempt in range(2):
+        pool = get_epub_pool()
+        try:
+            return pool.submit(fn, *args).result(timeout=CONVERT_TIMEOUT)
+        except BrokenProcessPool:
+            discard_epub_pool(pool)
+            if attempt:
+                raise
 
 
 def cleanup_old_files():
     """清理超过1小时的临时文件"""
-    import time
     current_time = time.time()
     
     for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER]:
-        if os.path.exists(folder):
-            for filename in os.listdir(folder):
-                filepath = os.path.join(folder, filename)
-                if os.path.isfile(filepath):
-                    file_time = os.path.getmtime(filepath)
+        try:
+            entries = os.scandir(folder)
+        except FileNotFoundError:
+            continue
+        
+        # scandir的DirEntry自带文件类型和stat缓存，省去逐个文件的isfile/getmtime调用
+        with entries:
+            for entry in entries:
+                try:
                     # 删除超过1小时的文件
-                    if current_time - file_time > 3600:
-                        try:
-                            os.remove(filepath)
-                        except:
-                            pass
+                    if entry.is_file(follow_symlinks=False) and current_time - entry.stat().st_mtime > 3600:
+                        os.unlink(entry.path)
+                        if folder == OUTPUT_FOLDER:
+                            _DOWNLOAD_MAP.pop(entry.name.split('_', 1)[0], None)
+                except FileNotFoundError:
+                    # 已被其他进程删除
+                    pass
+
+
+def _cleanup_loop():
+    """后台定期清理临时文件和过期的EPUB缓存（启动时先清理一次）"""
+    while True:
+        reap_epub_cache()
+        try:
+            cleanup_old_files()
+        except OSError:
+            # 权限等问题不应让清理线程退出
+            traceback.print_exc()
+        time.sleep(CLEANUP_INTERVAL)
+
+
+def start_cleanup_thread():
+    """启动后台清理线程（每个进程只启动一次）
+    
+    线程不会跨fork继承：gunicorn预加载应用时模块在master进程中导入，
+    所以不在导入时启动，而是由每个处理请求的进程按进程号判断后启动
+    """
+    global _cleanup_thread, _cleanup_pid
+    if _cleanup_pid == os.getpid():
+        return
+    with _cleanup_lock:
+        if _cleanup_pid != os.getpid():
+            _cleanup_thread = threading.Thread(target=_cleanup_loop, name='cleanup', daemon=True)
+            _cleanup_thread.start()
+            _cleanup_pid = os.getpid()
+
+
+@app.before_request
+def ensure_cleanup_thread():
+    """处理请求前确保当前进程的清理线程已启动"""
+    start_cleanup_thread()
 
 
 @app.route('/')
 def index():
     """主页"""
-    cleanup_old_files()
     return render_template('index.html')
 
 
@@ -81,18 +389,11 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': '没有选择文件'}), 400
         
-        if file and allowed_file(file.filename, ALLOWED_EXTENSIONS):
-            # 生成唯一文件名
-            unique_id = str(uuid.uuid4())
-            filename = secure_filename(f"{unique_id}_{file.filename}")
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            
-            # 保存文件
-            file.save(filepath)
-            
-            # 读取文件内容
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
+        if file and allowed_file(file.filename, ALLOWED_SUFFIXES):
+            # 直接在内存中读取文件内容（内容会随转换请求一起提交，无需落盘）
+            raw = file.stream.read()
+            unique_id = hashlib.blake2b(raw, digest_size=12).hexdigest()
+            content = raw.decode('utf-8')
             
             # 提取文件名作为默认标题
             title = os.path.splitext(file.filename)[0]
@@ -123,19 +424,23 @@ def upload_cover():
         if file.filename == '':
             return jsonify({'error': '没有选择文件'}), 400
         
-        if file and allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
-            # 生成唯一文件名
-            unique_id = str(uuid.uuid4())
-            ext = file.filename.rsplit('.', 1)[1].lower()
+        if file and allowed_file(file.filename, ALLOWED_IMAGE_SUFFIXES):
+            # 按内容生成文件名，相同图片只保存一份
+            unique_id = upload_id(file.stream)
+            ext = file.filename.rpartition('.')[2].lower()
             filename = f"{unique_id}_cover.{ext}"
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             
-            # 保存文件
-            file.save(filepath)
+            # 保存文件（已存在则只刷新修改时间，避免被定期清理；恰好被清理掉时重新保存）
+            try:
+                os.utime(filepath)
+            except FileNotFoundError:
+                save_upload(file, filepath)
             
             return jsonify({
                 'success': True,
                 'cover_id': unique_id,
+                'cover_ext': ext,
                 'filename': file.filename
             })
         else:
@@ -162,15 +467,11 @@ def convert_to_epub():
         content = data['content'].strip()
         cover_id = data.get('cover_id')
         
-        # 生成唯一ID用于文件名
-        unique_id = str(uuid.uuid4())
-        
-        # 创建临时Markdown文件
-        md_filename = f"{unique_id}_temp.md"
-        md_filepath = os.path.join(app.config['UPLOAD_FOLDER'], md_filename)
-        
-        with open(md_filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
+        # 按解析器、书籍信息和内容生成ID，相同的转换请求得到相同的文件
+        unique_id = hashlib.blake2b(
+            '\0'.join([markdown_parser(), title, author, content, cover_id or '']).encode('utf-8'),
+            digest_size=12
+        ).hexdigest()
         
         # 创建转换器实例
         converter = MarkdownEbookConverter()
@@ -178,38 +479,67 @@ def convert_to_epub():
         # 处理封面图片（如果有）
         cover_path = None
         if cover_id:
-            # 查找对应的封面文件
-            for ext in ['png', 'jpg', 'jpeg', 'gif']:
-                potential_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{cover_id}_cover.{ext}")
-                if os.path.exists(potential_path):
-                    cover_path = potential_path
-                    break
+            cover_ext = data.get('cover_ext')
+            if cover_ext in ALLOWED_IMAGE_EXTENSIONS:
+                # 上传时已返回扩展名，直接拼出封面路径
+                cover_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{cover_id}_cover.{cover_ext}")
+            else:
+                # 兼容未提交扩展名的请求：一次glob查找对应的封面文件
+                pattern = os.path.join(app.config['UPLOAD_FOLDER'], f"{glob.escape(cover_id)}_cover.*")
+                cover_path = next(glob.iglob(pattern), None)
         
         # 设置输出文件路径
-        epub_filename = f"{unique_id}_{secure_filename(title)}.epub"
+        display_name = f"{secure_filename(title)}.epub"
+        epub_filename = f"{unique_id}_{display_name}"
         epub_filepath = os.path.join(app.config['OUTPUT_FOLDER'], epub_filename)
         
+        # 相同的书已经生成过，直接复用（文件不存在或刚被清理线程删除时重新生成）
+        try:
+            os.utime(epub_filepath)
+        except FileNotFoundError:
+            pass
+        else:
+            _DOWNLOAD_MAP[unique_id] = (epub_filepath, display_name)
+            return jsonify({
+                'success': True,
+                'message': 'EPUB文件生成成功！',
+                'download_id': unique_id,
+                'filename': epub_filename
+            })
+        
         # 解析Markdown
         html_content = converter.parse_markdown_content(content)
         
-        # 提取标题
-        headings = converter.extract_headings(html_content)
+        # 提取标题并分割章节（只解析一次HTML）
+        headings, chapters = converter._parse_and_split(html_content)
         
-        # 分割章节
-        chapters = converter.split_content_by_chapters(html_content, headings)
+        # 在进程池中创建EPUB（压缩打包是CPU密集操作，不占用请求线程的GIL）
+        epub_data, has_cover = run_in_epub_pool(build_epub, chapters, headings, title, author, cover_path)
         
-        # 创建EPUB（修改create_epub方法以支持封面）
-        converter.create_epub_with_cover(chapters, headings, title, author, epub_filepath, cover_path)
+        # 同时落盘，供其他worker进程或缓存过期后下载；
+        # 封面文件已失效时生成的是不带封面的书，只在内存中保留，不能作为这个ID的结果复用
+        cover_missing = bool(cover_id) and not has_cover
+        if not cover_missing:
+            write_file_atomic(epub_filepath, epub_data)
+        _DOWNLOAD_MAP[unique_id] = (epub_filepath, display_name)
+        remember_epub(unique_id, epub_data)
         
-        return jsonify({
+        result = {
             'success': True,
             'message': 'EPUB文件生成成功！',
             'download_id': unique_id,
             'filename': epub_filename
-        })
+        }
+        if cover_missing:
+            result['warning'] = '封面图片已过期，生成的EPUB不含封面，请重新上传封面后再转换'
+        return jsonify(result)
         
+    except FuturesTimeoutError:
+        return jsonify({'error': '转换超时，请减少内容后重试'}), 504
+    except BrokenProcessPool:
+        traceback.print_exc()
+        return jsonify({'error': '转换服务暂时不可用，请稍后重试'}), 503
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({'error': f'转换失败: {str(e)}'}), 500
 
@@ -218,23 +548,42 @@ def convert_to_epub():
 def download_file(download_id):
     """下载生成的EPUB文件"""
     try:
-        # 查找文件
-        output_dir = app.config['OUTPUT_FOLDER']
-        epub_file = None
-        
-        for filename in os.listdir(output_dir):
-            if filename.startswith(download_id) and filename.endswith('.epub'):
-                epub_file = os.path.join(output_dir, filename)
-                break
-        
-        if not epub_file or not os.path.exists(epub_file):
+        # 查找文件（优先使用转换时记录的路径和下载文件名）
+        entry = _DOWNLOAD_MAP.get(download_id)
+        if entry is not None:
+            epub_file, display_name = entry
+        else:
+            # 其他worker进程生成的文件：glob查找并从文件名中提取原始文件名
+            pattern = os.path.join(app.config['OUTPUT_FOLDER'], f"{glob.escape(download_id)}_*.epub")
+            epub_file = next(glob.iglob(pattern), None)
+            display_name = os.path.basename(epub_file).partition('_')[2] if epub_file else None
+        
+        # 刚生成的文件直接从内存发送
+        cached = get_cached_epub(download_id) if epub_file else None
+        if cached is None and (not epub_file or not os.path.exists(epub_file)):
+            _DOWNLOAD_MAP.pop(download_id, None)
             return jsonify({'error': '文件不存在或已过期'}), 404
         
-        # 提取原始文件名
-        display_name = os.path.basename(epub_file)
-        if '_' in display_name:
-            display_name = '_'.join(display_name.split('_')[1:])
-        
+        if cached is not None:
+            # 内存中的文件没有路径，用内容摘要作为ETag，重复下载可返回304
+            epub_data, etag = cached
+            return send_file(
+                io.BytesIO(epub_data),
+                as_attachment=True,
+                download_name=display_name,
+                mimetype='application/epub+zip',
+                etag=etag
+            )
+        
+        accel_prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+        if accel_prefix:
+            # 交给nginx用sendfile直接发送文件，不经过Python进程
+            response = app.response_class(mimetype='application/epub+zip')
+            response.headers['X-Accel-Redirect'] = accel_prefix + os.path.basename(epub_file)
+            response.headers.set('Content-Disposition', 'attachment', filename=display_name)
+            return response
+        
+        # 磁盘文件：send_file自动附带ETag和Last-Modified，支持条件请求
         return send_file(
             epub_file,
             as_attachment=True,
@@ -260,155 +609,77 @@ def internal_error(e):
     return jsonify({'error': '服务器内部错误，请稍后重试'}), 500
 
 
+class StoredImageEpubWriter(epub.EpubWriter):
+    """图片本身已是压缩格式，写入时直接存储，不再做一遍DEFLATE"""
+    
+    def _write_items(self):
+        for item in self.book.get_items():
+            file_name = f"{self.book.FOLDER_NAME}/{item.file_name}"
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(file_name, self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(file_name, self._get_nav(item))
+            elif item.manifest:
+                is_image = (item.media_type or '').startswith('image/')
+                self.out.writestr(file_name, item.get_content(),
+                                  compress_type=zipfile.ZIP_STORED if is_image else zipfile.ZIP_DEFLATED)
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+
 # 扩展原有的MarkdownEbookConverter类
 class EnhancedMarkdownEbookConverter(MarkdownEbookConverter):
     """增强的Markdown转换器，支持封面图片"""
     
+    markdown_extensions = [
+        'extra',
+        'toc', 
+        'codehilite',
+        'tables'
+    ]
+    # 关闭Pygments的语言猜测（逐个词法分析器试探，代价很高）
+    markdown_extension_configs = {
+        'codehilite': {
+            'guess_lang': False
+        }
+    }
+    
+    # 使用Web版样式表，图片不再压缩
+    epub_style = WEB_EPUB_STYLE_BYTES
+    epub_writer_class = StoredImageEpubWriter
+    
     def parse_markdown_content(self, content):
-        """直接解析Markdown内容字符串"""
-        import markdown
-        
-        md = markdown.Markdown(extensions=[
-            'extra',
-            'toc', 
-            'codehilite',
-            'tables'
-        ])
-        html = md.convert(content)
-        return html
+        """直接解析Markdown内容字符串（相同内容直接命中缓存）"""
+        use_cmark = markdown_parser() == 'cmark'
+        key = content_key(b'cmark:' if use_cmark else b'markdown:', content)
+        html = cache_get(key)
+        if html is not None:
+            return html
+        
+        if use_cmark:
+            # GFM已内置表格和围栏代码块，UNSAFE保留原始HTML（与Python-Markdown一致）
+            html = cmarkgfm.github_flavored_markdown_to_html(
+                content, options=CmarkOptions.CMARK_OPT_UNSAFE)
+        else:
+            html = self._get_markdown().convert(content)
+        return cache_put(key, html, len(html))
     
-    def create_epub_with_cover(self, chapters, headings, title, author, output_file, cover_path=None):
-        """创建带封面的EPUB文件"""
-        from ebooklib import epub
-        import base64
-        
-        book = epub.EpubBook()
-        
-        # 设置书籍元数据
-        book.set_identifier('md2epub-web')
-        book.set_title(title)
-        book.set_language('zh-CN')
-        book.add_author(author)
-        
-        # 添加封面图片
-        if cover_path and os.path.exists(cover_path):
-            with open(cover_path, 'rb') as f:
-                cover_image = f.read()
-            
-            # 确定图片类型
-            ext = cover_path.split('.')[-1].lower()
-            media_type = f"image/{ext}" if ext in ['png', 'gif'] else "image/jpeg"
-            
-            book.set_cover("cover.jpg", cover_image)
-        
-        # CSS样式
-        style = '''
-        body { 
-            font-family: "Microsoft YaHei", "SimSun", serif; 
-            line-height: 1.6;
-            margin: 2em;
-        }
-        h1, h2, h3, h4, h5, h6 { 
-            color: #333; 
-            margin-top: 1.5em;
-            margin-bottom: 0.5em;
-        }
-        h1 { 
-            font-size: 1.8em; 
-            border-bottom: 2px solid #333;
-            padding-bottom: 0.3em;
-        }
-        h2 { 
-            font-size: 1.5em;
-            color: #666;
-        }
-        h3 { 
-            font-size: 1.3em;
-        }
-        p { 
-            margin-bottom: 1em;
-            text-align: justify;
-        }
-        ul, ol {
-            margin-left: 2em;
-        }
-        li {
-            margin-bottom: 0.5em;
-        }
-        strong {
-            font-weight: bold;
-            color: #d73502;
-        }
-        code {
-            background-color: #f4f4f4;
-            padding: 2px 4px;
-            border-radius: 3px;
-            font-family: "Courier New", monospace;
-        }
-        pre {
-            background-color: #f8f8f8;
-            padding: 1em;
-            border-radius: 5px;
-            overflow-x: auto;
-        }
-        blockquote {
-            border-left: 4px solid #ddd;
-            margin-left: 0;
-            padding-left: 1em;
-            color: #666;
-        }
-        '''
-        
-        nav_css = epub.EpubItem(uid="nav_css",
-                               file_name="style/nav.css",
-                               media_type="text/css",
-                               content=style)
-        book.add_item(nav_css)
-        
-        # 创建章节
-        epub_chapters = []
-        toc_entries = []
-        
-        for i, chapter in enumerate(chapters):
-            chapter_id = f"chapter_{i}"
-            chapter_file = f"chapter_{i}.xhtml"
-            
-            # 包装HTML内容
-            html_content = f'''<!DOCTYPE html>
-<html xmlns="http://www.w3.org/1999/xhtml">
-<head>
-    <title>{chapter['title']}</title>
-    <link rel="stylesheet" type="text/css" href="style/nav.css"/>
-</head>
-<body>
-{chapter['content']}
-</body>
-</html>'''
-            
-            c = epub.EpubHtml(title=chapter['title'],
-                             file_name=chapter_file,
-                             lang='zh-CN')
-            c.content = html_content
-            
-            book.add_item(c)
-            epub_chapters.append(c)
-            
-            # 添加到目录
-            toc_entries.append(epub.Link(chapter_file, chapter['title'], chapter_id))
-        
-        # 生成详细目录结构
-        detailed_toc = self.create_detailed_toc(headings, chapters)
-        book.toc = detailed_toc
-        
-        # 添加导航文件
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
-        
-        # 设置书脊
-        book.spine = ['nav'] + epub_chapters
-        
-        # 写入EPUB文件
-        epub.write_epub(output_file, book, {})
+    def _parse_and_split(self, html_content):
+        """一次解析得到标题和章节（按HTML哈希缓存）"""
+        key = content_key(b'chapters:', html_content)
+        result = cache_get(key)
+        if result is None:
+            # 章节内容合起来约等于整个HTML，按HTML长度估算大小
+            result = cache_put(key, super()._parse_and_split(html_content), len(html_content))
+        return result
+
+
+def build_epub(chapters, headings, title, author, cover_path=None):
+    """在进程池中生成EPUB，返回(文件内容, 是否加入了封面)"""
+    buffer = io.BytesIO()
+    has_cover = EnhancedMarkdownEbookConverter().create_epub_with_cover(
+        chapters, headings, title, author, buffer, cover_path)
+    return buffer.getvalue(), has_cover
 
 
 # 替换原有的转换器
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 配置：Markdown to EPUB Web 服务
+
+    gunicorn -c gunicorn_conf.py wsgi:application
+"""
+
+import os
+import multiprocessing
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 5000)}"
+
+# 每个CPU核一个worker进程，Markdown解析等CPU密集工作可以并行
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = 8
+
+# 预加载应用，worker之间共享已加载的模块（写时复制）
+# 生成EPUB的进程池在worker中首次转换时才创建，后台清理线程在worker处理首个请求时启动，
+# 都不会留在master进程中
+preload_app = True
+
+# 转换本身最长等待60秒（app.CONVERT_TIMEOUT），留出余量
+timeout = 120
@@ -7,18 +7,247 @@ Markdown to EPUB Converter Module
 
 import os
 import re
+import html as html_lib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import markdown
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
 from ebooklib import epub
 
+# 标题标签集合（遍历文档树时按标签名O(1)判断）
+HEADING_TAGS = frozenset(('h1', 'h2', 'h3', 'h4', 'h5', 'h6'))
+# 标题标签对应的级别
+HEADING_LEVELS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+
+# 代码语言推断的关键字表（导入时构建一次），按检测优先级排列
+LANGUAGE_KEYWORDS = (
+    ('sql', ('select', 'insert', 'update', 'delete', 'create', 'drop', 'alter', 'from', 'where', 'join')),
+    ('python', ('def ', 'import ', 'from ', 'class ', 'if __name__', 'print(')),
+    ('javascript', ('function', 'var ', 'let ', 'const ', 'console.log', '=>')),
+    ('java', ('public class', 'public static', 'system.out.println')),
+)
+# 展开为(关键字, 语言)序列，推断时只需一个循环
+KEYWORD_LANGUAGES = tuple((keyword, lang) for lang, keywords in LANGUAGE_KEYWORDS for keyword in keywords)
+# shebang行中的解释器名称对应的语言，其余解释器按bash处理
+SHEBANG_LANGUAGES = (('python', 'python'), ('node', 'javascript'))
+BASH_KEYWORDS = ('#!/bin/bash', 'echo ', 'cd ', 'ls ', 'chmod ', 'sudo ')
+HTML_TAG_RE = re.compile(r'<(?:html|div|p>|span)')
+# 代码块class中的语言声明，如language-python、highlight-js
+LANG_CLASS_RE = re.compile(r'(?:language|highlight)-(.+)')
+
+# 直接在HTML字符串上处理代码块所用的正则
+PRE_BLOCK_RE = re.compile(r'<pre\b([^>]*)>(.*?)</pre>', re.S | re.I)
+CODE_OPEN_RE = re.compile(r'<code\b([^>]*)>', re.I)
+CLASS_ATTR_RE = re.compile(r'''\sclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''', re.I)
+TAG_RE = re.compile(r'<[^>]*>')
+
+# 章节XHTML模板的固定部分（预先编码为字节，每章只拼接标题和正文）
+XHTML_HEAD = b'''<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+    <title>'''
+XHTML_MID = b'''</title>
+    <link rel="stylesheet" type="text/css" href="style/nav.css"/>
+</head>
+<body>
+'''
+XHTML_TAIL = b'''
+</body>
+</html>'''
+
+# 封面图片扩展名 -> EPUB内的封面文件名（ebooklib根据文件名写入media-type）
+COVER_FILE_NAMES = {
+    'png': 'cover.png',
+    'gif': 'cover.gif',
+    'jpg': 'cover.jpg',
+    'jpeg': 'cover.jpg',
+}
+
+# EPUB样式表（模块加载时编码为字节，所有书籍共用一份）
+EPUB_STYLE = '''
+body {
+    font-family: "Microsoft YaHei", "SimSun", serif;
+    line-height: 1.6;
+    margin: 2em;
+}
+h1, h2, h3, h4, h5, h6 {
+    color: #333;
+    margin-top: 1.5em;
+    margin-bottom: 0.5em;
+}
+h1 {
+    font-size: 1.8em;
+    border-bottom: 2px solid #333;
+    padding-bottom: 0.3em;
+}
+h2 {
+    font-size: 1.5em;
+    color: #666;
+}
+h3 {
+    font-size: 1.3em;
+}
+p {
+    margin-bottom: 1em;
+    text-align: justify;
+}
+ul, ol {
+    margin-left: 2em;
+}
+li {
+    margin-bottom: 0.5em;
+}
+strong {
+    font-weight: bold;
+    color: #d73502;
+}
+/* 行内代码样式 */
+code {
+    background-color: #f1f3f4;
+    color: #c7254e;
+    padding: 2px 6px;
+    border-radius: 4px;
+    font-family: "Consolas", "Monaco", "Courier New", monospace;
+    font-size: 0.9em;
+    border: 1px solid #e1e4e8;
+}
+/* 代码块样式 */
+pre {
+    background-color: #f8f9fa;
+    border: 1px solid #e1e4e8;
+    border-radius: 6px;
+    padding: 16px;
+    margin: 16px 0;
+    overflow-x: auto;
+    line-height: 1.45;
+    position: relative;
+}
+pre code {
+    background-color: transparent;
+    color: #24292e;
+    padding: 0;
+    border: none;
+    font-family: "Consolas", "Monaco", "Courier New", monospace;
+    font-size: 0.85em;
+    white-space: pre;
+    word-wrap: normal;
+}
+/* 代码块语言标签 */
+.code-lang {
+    position: absolute;
+    top: 8px;
+    right: 12px;
+    font-size: 0.75em;
+    color: #586069;
+    background-color: #ffffff;
+    padding: 2px 6px;
+    border-radius: 3px;
+    border: 1px solid #e1e4e8;
+}
+/* 语法高亮 - 关键字 */
+.highlight .k, .highlight .kd, .highlight .kn, .highlight .kr, .highlight .kt {
+    color: #d73a49;
+    font-weight: bold;
+}
+/* 语法高亮 - 字符串 */
+.highlight .s, .highlight .s1, .highlight .s2, .highlight .sb, .highlight .sc {
+    color: #032f62;
+}
+/* 语法高亮 - 注释 */
+.highlight .c, .highlight .c1, .highlight .cm {
+    color: #6a737d;
+    font-style: italic;
+}
+/* 语法高亮 - 数字 */
+.highlight .m, .highlight .mi, .highlight .mf, .highlight .mh, .highlight .mo {
+    color: #005cc5;
+}
+/* 语法高亮 - 函数名 */
+.highlight .nf {
+    color: #6f42c1;
+    font-weight: bold;
+}
+/* 语法高亮 - 变量 */
+.highlight .n, .highlight .na, .highlight .nb, .highlight .nc, .highlight .nd, .highlight .ne, .highlight .ni, .highlight .nl, .highlight .nn, .highlight .nt, .highlight .nv, .highlight .nx {
+    color: #24292e;
+}
+/* 语法高亮 - 操作符 */
+.highlight .o {
+    color: #d73a49;
+}
+blockquote {
+    border-left: 4px solid #ddd;
+    margin-left: 0;
+    padding-left: 1em;
+    color: #666;
+}
+'''
+EPUB_STYLE_BYTES = EPUB_STYLE.encode('utf-8')
+
+# 后台读取封面等文件的线程池（按进程创建，fork出的子进程不会继承失效的线程）
+_io_pool = None
+_io_pool_pid = None
+_io_pool_lock = threading.Lock()
+
+
+def get_io_pool():
+    """获取当前进程的文件读取线程池"""
+    global _io_pool, _io_pool_pid
+    with _io_pool_lock:
+        if _io_pool is None or _io_pool_pid != os.getpid():
+            _io_pool = ThreadPoolExecutor(max_workers=2)
+            _io_pool_pid = os.getpid()
+        return _io_pool
+
 
 class MarkdownEbookConverter:
     """Markdown转EPUB转换器"""
     
+    # Markdown扩展及其配置（子类可覆盖）
+    markdown_extensions = [
+        'extra',
+        'toc', 
+        'codehilite',
+        'tables',
+        'fenced_code'
+    ]
+    markdown_extension_configs = {
+        'codehilite': {
+            'css_class': 'highlight',
+            'use_pygments': True,
+            'guess_lang': False,  # 不让Pygments逐个词法分析器猜测，语言标签由_guess_language推断
+            'linenums': False
+        }
+    }
+    
+    # EPUB样式表和写入器（子类可覆盖）
+    epub_style = EPUB_STYLE_BYTES
+    epub_writer_class = epub.EpubWriter
+    
+    # 每个线程复用的Markdown实例（Markdown对象不是线程安全的）
+    _markdown_local = threading.local()
+    
     def __init__(self):
         """初始化转换器"""
         pass
     
+    def _get_markdown(self):
+        """获取当前线程复用的Markdown实例，避免每次转换重新加载扩展
+        
+        Returns:
+            markdown.Markdown: 已重置、可直接使用的Markdown实例
+        """
+        instances = self._markdown_local.__dict__.setdefault('instances', {})
+        md = instances.get(type(self))
+        if md is None:
+            md = markdown.Markdown(extensions=self.markdown_extensions,
+                                   extension_configs=self.markdown_extension_configs)
+            instances[type(self)] = md
+        else:
+            md.reset()
+        return md
+    
     def parse_markdown_content(self, content):
         """解析Markdown内容为HTML
         
@@ -28,21 +257,7 @@ class MarkdownEbookConverter:
         Returns:
             str: 转换后的HTML内容
         """
-        md = markdown.Markdown(extensions=[
-            'extra',
-            'toc', 
-            'codehilite',
-            'tables',
-            'fenced_code'
-        ], extension_configs={
-            'codehilite': {
-                'css_class': 'highlight',
-                'use_pygments': True,
-                'guess_lang': True,
-                'linenums': False
-            }
-        })
-        html = md.convert(content)
+        html = self._get_markdown().convert(content)
         
         # 处理代码块，添加语言标签
         html = self._process_code_blocks(html)
@@ -52,30 +267,98 @@ class MarkdownEbookConverter:
     def _process_code_blocks(self, html):
         """处理代码块，添加语言标签和改进样式
         
+        优先直接在HTML字符串上处理；遇到嵌套等无法可靠处理的结构时回退到BeautifulSoup
+        
+        Args:
+            html (str): HTML内容
+            
+        Returns:
+            str: 处理后的HTML内容
+        """
+        if isinstance(html, str):
+            result = self._process_code_blocks_text(html)
+            if result is not None:
+                return result
+        return self._process_code_blocks_soup(html)
+    
+    def _process_code_blocks_text(self, html):
+        """用正则在HTML字符串上处理代码块，代码块以外的内容原样保留
+        
         Args:
             html (str): HTML内容
             
+        Returns:
+            str: 处理后的HTML内容；结构无法可靠处理时返回None
+        """
+        if '<!--' in html:
+            # 正则无法区分注释内外的代码块，含注释时交给BeautifulSoup处理
+            return None
+        
+        parts = []
+        pos = 0
+        
+        for block in PRE_BLOCK_RE.finditer(html):
+            pre_attrs, inner = block.group(1), block.group(2)
+            code_open = CODE_OPEN_RE.search(inner)
+            if code_open is None:
+                continue
+            
+            code_attrs = code_open.group(1)
+            code_end = inner.find('</code>', code_open.end())
+            if (code_end < 0 or '<pre' in inner.lower()
+                    or self._has_open_quote(pre_attrs) or self._has_open_quote(code_attrs)
+                    or self._has_unparsed_class(pre_attrs) or self._has_unparsed_class(code_attrs)):
+                # 嵌套的pre、未闭合的code、属性值中含有'>'或class无法解析，交给BeautifulSoup处理
+                return None
+            
+            # 获取语言信息：先从class中提取，没有则从内容推断
+            lang = self._class_language(self._attr_classes(code_attrs))
+            if not lang:
+                code_text = html_lib.unescape(TAG_RE.sub('', inner[code_open.end():code_end]))
+                lang = self._guess_language(code_text.strip().lower())
+            
+            # 确保pre标签有正确的class
+            class_attr = CLASS_ATTR_RE.search(pre_attrs)
+            pre_classes = self._attr_classes(pre_attrs, class_attr)
+            if 'highlight' not in pre_classes:
+                pre_classes.append('highlight')
+                new_class = f' class="{html_lib.escape(" ".join(pre_classes))}"'
+                if class_attr:
+                    pre_attrs = pre_attrs[:class_attr.start()] + new_class + pre_attrs[class_attr.end():]
+                else:
+                    pre_attrs += new_class
+            
+            # 添加语言标签
+            parts.append(html[pos:block.start()])
+            parts.append(f'<pre{pre_attrs}><span class="code-lang">'
+                         f'{html_lib.escape(lang.upper(), quote=False)}</span>{inner}</pre>')
+            pos = block.end()
+        
+        parts.append(html[pos:])
+        return ''.join(parts)
+    
+    def _process_code_blocks_soup(self, html):
+        """用BeautifulSoup处理代码块（字符串处理的回退路径）
+        
+        代码块以外的内容需要原样保留，所以用html.parser解析：lxml会补全段落、
+        改写meta字符集，并把开头的注释、style等移出body
+        
+        Args:
+            html (str|BeautifulSoup): HTML内容或已解析的文档树
+            
         Returns:
             str: 处理后的HTML内容
         """
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = self._parse_html(html, 'html.parser')
         
-        # 处理所有代码块
-        for pre in soup.find_all('pre'):
+        # 单次遍历文档树，处理所有代码块
+        for pre in soup.descendants:
+            if pre.name != 'pre':
+                continue
             code = pre.find('code')
             if code:
                 # 获取语言信息
-                lang = None
-                classes = code.get('class', [])
-                
-                # 从class中提取语言信息
-                for cls in classes:
-                    if cls.startswith('language-'):
-                        lang = cls.replace('language-', '')
-                        break
-                    elif cls.startswith('highlight-'):
-                        lang = cls.replace('highlight-', '')
-                        break
+                lang = self._class_language(code.get('class', []))
                 
                 # 如果没有指定语言，尝试从内容推断
                 if not lang:
@@ -84,15 +367,111 @@ class MarkdownEbookConverter:
                 
                 # 添加语言标签
                 if lang:
-                    lang_span = soup.new_tag('span', class_='code-lang')
+                    lang_span = soup.new_tag('span', attrs={'class': 'code-lang'})
                     lang_span.string = lang.upper()
                     pre.insert(0, lang_span)
                 
-                # 确保pre标签有正确的class
-                if 'highlight' not in pre.get('class', []):
-                    pre['class'] = pre.get('class', []) + ['highlight']
+                # 确保pre标签有正确的class（原地追加，不重复查找属性）
+                pre_classes = pre.get('class') or []
+                if 'highlight' not in pre_classes:
+                    pre_classes.append('highlight')
+                    pre['class'] = pre_classes
+        
+        return self._serialize_html(soup)
+    
+    def _class_language(self, classes):
+        """从代码块的class列表中提取语言声明
+        
+        Args:
+            classes (list): class列表
+            
+        Returns:
+            str: 语言名称，没有声明时返回None
+        """
+        for cls in classes:
+            match = LANG_CLASS_RE.match(cls)
+            if match:
+                return match.group(1)
+        return None
+    
+    def _attr_classes(self, attrs, class_attr=None):
+        """从标签属性字符串中解析class列表
+        
+        Args:
+            attrs (str): 标签属性字符串
+            class_attr (re.Match, optional): 已匹配到的class属性
+            
+        Returns:
+            list: class列表
+        """
+        if class_attr is None:
+            class_attr = CLASS_ATTR_RE.search(attrs)
+        if class_attr is None:
+            return []
+        value = next(group for group in class_attr.groups() if group is not None)
+        return html_lib.unescape(value).split()
+    
+    def _has_open_quote(self, attrs):
+        """属性字符串中引号不成对，说明属性值里有'>'，正则截断了标签
+        
+        Args:
+            attrs (str): 标签属性字符串
+            
+        Returns:
+            bool: 是否有未闭合的引号
+        """
+        return attrs.count('"') % 2 == 1 or attrs.count("'") % 2 == 1
+    
+    def _has_unparsed_class(self, attrs):
+        """属性字符串中有class却没能解析出来（如空值或重复的class），正则无法可靠处理
         
-        return str(soup)
+        Args:
+            attrs (str): 标签属性字符串
+            
+        Returns:
+            bool: 是否有无法解析的class属性
+        """
+        matches = len(CLASS_ATTR_RE.findall(attrs))
+        return matches > 1 or matches != attrs.lower().count('class')
+    
+    def _parse_html(self, html_content, features='lxml'):
+        """解析HTML为文档树（默认使用C实现的lxml解析器）；已解析的文档树直接返回
+        
+        Args:
+            html_content (str|BeautifulSoup): HTML内容或已解析的文档树
+            features (str): BeautifulSoup解析器名称
+            
+        Returns:
+            BeautifulSoup: 文档树
+        """
+        if isinstance(html_content, BeautifulSoup):
+            return html_content
+        return BeautifulSoup(html_content, features)
+    
+    def _serialize_html(self, soup):
+        """把文档树序列化为HTML片段，去掉lxml补全的html/head/body标签
+        
+        lxml会把开头的注释放到html之前，把开头的style、link、meta、title放进head，
+        所以按文档顺序输出这些节点和body的内容，而不是只输出body
+        
+        Args:
+            soup (BeautifulSoup): 文档树
+            
+        Returns:
+            str: HTML内容
+        """
+        parts = []
+        for node in soup.contents:
+            children = node.contents if node.name == 'html' else [node]
+            for child in children:
+                if child.name in ('head', 'body'):
+                    parts.append(child.decode_contents())
+                elif isinstance(child, NavigableString):
+                    # 注释等特殊字符串需要output_ready才会带上<!-- -->等标记
+                    parts.append(child.output_ready())
+                else:
+                    parts.append(child.decode())
+        return ''.join(parts)
     
     def _guess_language(self, code_text):
         """根据代码内容推断编程语言
@@ -103,28 +482,21 @@ class MarkdownEbookConverter:
         Returns:
             str: 推断的语言名称，如果无法推断则返回'text'
         """
-        # SQL关键字检测
-        sql_keywords = ['select', 'insert', 'update', 'delete', 'create', 'drop', 'alter', 'from', 'where', 'join']
-        if any(keyword in code_text for keyword in sql_keywords):
-            return 'sql'
-        
-        # Python关键字检测
-        python_keywords = ['def ', 'import ', 'from ', 'class ', 'if __name__', 'print(']
-        if any(keyword in code_text for keyword in python_keywords):
-            return 'python'
-        
-        # JavaScript关键字检测
-        js_keywords = ['function', 'var ', 'let ', 'const ', 'console.log', '=>']
-        if any(keyword in code_text for keyword in js_keywords):
-            return 'javascript'
-        
-        # Java关键字检测
-        java_keywords = ['public class', 'public static', 'system.out.println']
-        if any(keyword in code_text for keyword in java_keywords):
-            return 'java'
+        # 以shebang开头时直接由解释器判断，不再做关键字扫描
+        if code_text.startswith('#!'):
+            interpreter = code_text.split('\n', 1)[0]
+            for name, lang in SHEBANG_LANGUAGES:
+                if name in interpreter:
+                    return lang
+            return 'bash'
+        
+        # SQL、Python、JavaScript、Java关键字检测（按优先级）
+        for keyword, lang in KEYWORD_LANGUAGES:
+            if keyword in code_text:
+                return lang
         
         # HTML标签检测
-        if '<' in code_text and '>' in code_text and any(tag in code_text for tag in ['<html', '<div', '<p>', '<span']):
+        if '<' in code_text and '>' in code_text and HTML_TAG_RE.search(code_text):
             return 'html'
         
         # CSS检测
@@ -132,8 +504,7 @@ class MarkdownEbookConverter:
             return 'css'
         
         # Shell/Bash检测
-        bash_keywords = ['#!/bin/bash', 'echo ', 'cd ', 'ls ', 'chmod ', 'sudo ']
-        if any(keyword in code_text for keyword in bash_keywords):
+        if any(keyword in code_text for keyword in BASH_KEYWORDS):
             return 'bash'
         
         # 如果无法推断，返回通用类型
@@ -143,16 +514,32 @@ class MarkdownEbookConverter:
         """提取HTML中的标题结构
         
         Args:
-            html_content (str): HTML内容
+            html_content (str|BeautifulSoup): HTML内容，或已解析的文档树（避免重复解析）
             
         Returns:
             list: 标题列表，每个元素包含level, title, id等信息
         """
-        soup = BeautifulSoup(html_content, 'html.parser')
+        soup = self._parse_html(html_content)
+        return self._collect_headings(soup)
+    
+    def _collect_headings(self, soup, elements=None):
+        """在已解析的文档树中收集标题，并为每个标题设置ID
+        
+        Args:
+            soup (BeautifulSoup): 已解析的HTML文档
+            elements (list, optional): 传入时按顺序追加标题元素，供分割章节时复用
+            
+        Returns:
+            list: 标题列表
+        """
         headings = []
         
-        for i, heading in enumerate(soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])):
-            level = int(heading.name[1])  # 提取数字部分
+        # 单次遍历文档树，只处理标题标签
+        for heading in soup.descendants:
+            level = HEADING_LEVELS.get(heading.name)
+            if level is None:
+                continue
+            i = len(headings)
             title = heading.get_text().strip()
             
             # 生成ID
@@ -162,9 +549,10 @@ class MarkdownEbookConverter:
             headings.append({
                 'level': level,
                 'title': title,
-                'id': heading_id,
-                'element': heading
+                'id': heading_id
             })
+            if elements is not None:
+                elements.append(heading)
         
         return headings
     
@@ -172,88 +560,153 @@ class MarkdownEbookConverter:
         """根据标题将内容分割为章节
         
         Args:
-            html_content (str): HTML内容
+            html_content (str|BeautifulSoup): HTML内容，或已解析的文档树（避免重复解析）
             headings (list): 标题列表
             
         Returns:
             list: 章节列表，每个章节包含title和content
         """
-        soup = BeautifulSoup(html_content, 'html.parser')
-        chapters = []
+        if isinstance(html_content, str) and self._split_level(headings) is None:
+            # 不需要分章时直接使用原始HTML，省去解析和序列化
+            return [{'title': '正文', 'content': html_content}]
+        soup = self._parse_html(html_content)
+        return self._split_chapters(soup, headings)
+    
+    def _parse_and_split(self, html_content):
+        """只解析一次HTML，同时得到标题列表和章节列表
         
-        if not headings:
-            # 如果没有标题，整个内容作为一章
-            chapters.append({
-                'title': '正文',
-                'content': str(soup)
-            })
-            return chapters
+        Args:
+            html_content (str|BeautifulSoup): HTML内容或已解析的文档树
+            
+        Returns:
+            tuple: (标题列表, 章节列表)
+        """
+        soup = self._parse_html(html_content)
+        
+        # 收集标题的同一次遍历中记下标题元素，分割章节时不再遍历文档树
+        elements = []
+        headings = self._collect_headings(soup, elements)
+        if isinstance(html_content, str) and self._split_level(headings) is None:
+            # 不需要分章时直接使用原始HTML，省去序列化
+            return headings, [{'title': '正文', 'content': html_content}]
+        return headings, self._split_chapters(soup, headings, elements)
+    
+    def _split_level(self, headings):
+        """确定作为章节分界点的标题级别
         
-        # 找到所有一级标题作为章节分界点
-        h1_headings = [h for h in headings if h['level'] == 1]
+        Args:
+            headings (list): 标题列表
+            
+        Returns:
+            int: 1或2；没有一级和二级标题时返回None
+        """
+        levels = {h['level'] for h in headings}
+        return 1 if 1 in levels else 2 if 2 in levels else None
+    
+    def _split_chapters(self, soup, headings, elements=None):
+        """在已解析的文档树上按标题分割章节
         
-        if not h1_headings:
-            # 如果没有一级标题，使用二级标题
-            h1_headings = [h for h in headings if h['level'] == 2]
+        Args:
+            soup (BeautifulSoup): 已解析的HTML文档
+            headings (list): 标题列表
+            elements (list, optional): 与headings一一对应的标题元素（由_collect_headings收集）
+            
+        Returns:
+            list: 章节列表
+        """
+        chapters = []
+        
+        # 找到所有一级标题作为章节分界点；如果没有一级标题，使用二级标题
+        split_level = self._split_level(headings)
+        
+        if elements is None:
+            # 按文档顺序定位标题元素（第i个标题标签对应headings[i]），
+            # 同时补上标题ID，这样传入未修改过的HTML也能得到一致的结果
+            elements = []
+            for element in soup.descendants:
+                if element.name not in HEADING_TAGS:
+                    continue
+                if len(elements) < len(headings):
+                    element['id'] = headings[len(elements)]['id']
+                elements.append(element)
+        
+        h1_headings = []
+        chapter_elements = []
+        for heading, element in zip(headings, elements):
+            if heading['level'] == split_level:
+                h1_headings.append(heading)
+                chapter_elements.append(element)
         
         if not h1_headings:
-            # 如果没有二级标题，整个内容作为一章
+            # 如果没有一级或二级标题，整个内容作为一章
             chapters.append({
                 'title': '正文',
-                'content': str(soup)
+                'content': self._serialize_html(soup)
             })
             return chapters
         
-        # 按章节分割内容
-        for i, heading in enumerate(h1_headings):
-            chapter_title = heading['title']
-            
-            # 找到当前章节的开始和结束位置
-            current_element = heading['element']
-            chapter_content = []
-            
-            # 收集从当前标题到下一个同级标题之间的所有内容
-            next_sibling = current_element
-            while next_sibling:
-                next_sibling = next_sibling.find_next_sibling()
-                
-                if next_sibling and next_sibling.name in ['h1', 'h2'] and \
-                   (next_sibling.name == 'h1' or (heading['level'] == 2 and next_sibling.name == 'h2')):
-                    # 遇到下一个同级或更高级标题，停止
-                    break
-                elif next_sibling:
-                    chapter_content.append(str(next_sibling))
-            
-            # 包含当前标题
-            full_content = str(current_element) + ''.join(chapter_content)
+        # 按章节分割内容：每个父节点的子节点只线性扫描一次，
+        # 遇到章节标题就开始新章节，其余标签追加到当前章节
+        chapter_index = {id(element): i for i, element in enumerate(chapter_elements)}
+        chapter_parts = [[] for _ in chapter_elements]
+        scanned_parents = set()
+        
+        for element in chapter_elements:
+            parent = element.parent
+            if id(parent) in scanned_parents:
+                continue
+            scanned_parents.add(id(parent))
             
+            current = None
+            for node in parent.children:
+                if node.name is None:
+                    # 跳过标签之间的文本和空白
+                    continue
+                index = chapter_index.get(id(node))
+                if index is not None:
+                    current = chapter_parts[index]
+                if current is not None:
+                    current.append(str(node))
+        
+        for heading, parts in zip(h1_headings, chapter_parts):
             chapters.append({
-                'title': chapter_title,
-                'content': full_content
+                'title': heading['title'],
+                'content': ''.join(parts)
             })
         
         return chapters
     
-    def create_detailed_toc(self, headings, chapters):
-        """创建详细的目录结构
+    def create_epub(self, chapters, headings, title, author, output_file):
+        """创建EPUB文件
         
         Args:
+            chapters (list): 章节列表
             headings (list): 标题列表
+            title (str): 书籍标题
+            author (str): 作者
+            output_file (str): 输出文件路径
+        """
+        self._build_epub(chapters, headings, title, author, output_file, identifier='md2epub')
+    
+    def create_epub_with_cover(self, chapters, headings, title, author, output_file, cover_path=None):
+        """创建带封面的EPUB文件
+        
+        Args:
             chapters (list): 章节列表
+            headings (list): 标题列表
+            title (str): 书籍标题
+            author (str): 作者
+            output_file (str): 输出文件路径
+            cover_path (str, optional): 封面图片路径
             
         Returns:
-            list: EPUB目录结构
+            bool: 是否加入了封面（封面文件不存在时为False）
         """
-        toc_entries = []
-        
-        for i, chapter in enumerate(chapters):
-            chapter_file = f"chapter_{i}.xhtml"
-            toc_entries.append(epub.Link(chapter_file, chapter['title'], f"chapter_{i}"))
-        
-        return toc_entries
+        return self._build_epub(chapters, headings, title, author, output_file,
+                                identifier='md2epub-web', cover_path=cover_path)
     
-    def create_epub(self, chapters, headings, title, author, output_file):
-        """创建EPUB文件
+    def _build_epub(self, chapters, headings, title, author, output_file, identifier, cover_path=None):
+        """组装并写入EPUB文件（create_epub和create_epub_with_cover共用）
         
         Args:
             chapters (list): 章节列表
@@ -261,171 +714,43 @@ class MarkdownEbookConverter:
             title (str): 书籍标题
             author (str): 作者
             output_file (str): 输出文件路径
+            identifier (str): 书籍标识符
+            cover_path (str, optional): 封面图片路径
+            
+        Returns:
+            bool: 是否加入了封面
         """
         book = epub.EpubBook()
         
         # 设置书籍元数据
-        book.set_identifier('md2epub')
+        book.set_identifier(identifier)
         book.set_title(title)
         book.set_language('zh-CN')
         book.add_author(author)
         
-        # CSS样式
-        style = '''
-        body { 
-            font-family: "Microsoft YaHei", "SimSun", serif; 
-            line-height: 1.6;
-            margin: 2em;
-        }
-        h1, h2, h3, h4, h5, h6 { 
-            color: #333; 
-            margin-top: 1.5em;
-            margin-bottom: 0.5em;
-        }
-        h1 { 
-            font-size: 1.8em; 
-            border-bottom: 2px solid #333;
-            padding-bottom: 0.3em;
-        }
-        h2 { 
-            font-size: 1.5em;
-            color: #666;
-        }
-        h3 { 
-            font-size: 1.3em;
-        }
-        p { 
-            margin-bottom: 1em;
-            text-align: justify;
-        }
-        ul, ol {
-            margin-left: 2em;
-        }
-        li {
-            margin-bottom: 0.5em;
-        }
-        strong {
-            font-weight: bold;
-            color: #d73502;
-        }
-        /* 行内代码样式 */
-        code {
-            background-color: #f1f3f4;
-            color: #c7254e;
-            padding: 2px 6px;
-            border-radius: 4px;
-            font-family: "Consolas", "Monaco", "Courier New", monospace;
-            font-size: 0.9em;
-            border: 1px solid #e1e4e8;
-        }
-        /* 代码块样式 */
-        pre {
-            background-color: #f8f9fa;
-            border: 1px solid #e1e4e8;
-            border-radius: 6px;
-            padding: 16px;
-            margin: 16px 0;
-            overflow-x: auto;
-            line-height: 1.45;
-            position: relative;
-        }
-        pre code {
-            background-color: transparent;
-            color: #24292e;
-            padding: 0;
-            border: none;
-            font-family: "Consolas", "Monaco", "Courier New", monospace;
-            font-size: 0.85em;
-            white-space: pre;
-            word-wrap: normal;
-        }
-        /* 代码块语言标签 */
-        .code-lang {
-            position: absolute;
-            top: 8px;
-            right: 12px;
-            font-size: 0.75em;
-            color: #586069;
-            background-color: #ffffff;
-            padding: 2px 6px;
-            border-radius: 3px;
-            border: 1px solid #e1e4e8;
-        }
-        /* 语法高亮 - 关键字 */
-        .highlight .k, .highlight .kd, .highlight .kn, .highlight .kr, .highlight .kt { 
-            color: #d73a49; 
-            font-weight: bold; 
-        }
-        /* 语法高亮 - 字符串 */
-        .highlight .s, .highlight .s1, .highlight .s2, .highlight .sb, .highlight .sc { 
-            color: #032f62; 
-        }
-        /* 语法高亮 - 注释 */
-        .highlight .c, .highlight .c1, .highlight .cm { 
-            color: #6a737d; 
-            font-style: italic; 
-        }
-        /* 语法高亮 - 数字 */
-        .highlight .m, .highlight .mi, .highlight .mf, .highlight .mh, .highlight .mo { 
-            color: #005cc5; 
-        }
-        /* 语法高亮 - 函数名 */
-        .highlight .nf { 
-            color: #6f42c1; 
-            font-weight: bold; 
-        }
-        /* 语法高亮 - 变量 */
-        .highlight .n, .highlight .na, .highlight .nb, .highlight .nc, .highlight .nd, .highlight .ne, .highlight .ni, .highlight .nl, .highlight .nn, .highlight .nt, .highlight .nv, .highlight .nx { 
-            color: #24292e; 
-        }
-        /* 语法高亮 - 操作符 */
-        .highlight .o { 
-            color: #d73a49; 
-        }
-        blockquote {
-            border-left: 4px solid #ddd;
-            margin-left: 0;
-            padding-left: 1em;
-            color: #666;
-        }
-        '''
+        # 在后台读取封面图片，与构建章节同时进行
+        cover_future = self._read_cover(cover_path)
         
         nav_css = epub.EpubItem(uid="nav_css",
                                file_name="style/nav.css",
                                media_type="text/css",
-                               content=style)
+                               content=self.epub_style)
         book.add_item(nav_css)
         
-        # 创建章节
+        # 创建章节，同时生成目录（每个章节只访问一次）
         epub_chapters = []
+        toc_entries = []
         
         for i, chapter in enumerate(chapters):
-            chapter_id = f"chapter_{i}"
-            chapter_file = f"chapter_{i}.xhtml"
-            
-            # 包装HTML内容
-            html_content = f'''<!DOCTYPE html>
-<html xmlns="http://www.w3.org/1999/xhtml">
-<head>
-    <title>{chapter['title']}</title>
-    <link rel="stylesheet" type="text/css" href="style/nav.css"/>
-</head>
-<body>
-{chapter['content']}
-</body>
-</html>'''
-            
-            c = epub.EpubHtml(title=chapter['title'],
-                             file_name=chapter_file,
-                             lang='zh-CN')
-            c.content = html_content
-            
+            c = self._make_chapter(i, chapter)
             book.add_item(c)
             epub_chapters.append(c)
+            toc_entries.append(epub.Link(c.file_name, chapter['title'], f"chapter_{i}"))
         
-        # 生成目录结构
-        detailed_toc = self.create_detailed_toc(headings, chapters)
-        book.toc = detailed_toc
+        book.toc = toc_entries
+        
+        # 添加封面图片
+        has_cover = self._add_cover(book, cover_path, cover_future)
         
         # 添加导航文件
         book.add_item(epub.EpubNcx())
@@ -435,204 +760,66 @@ class MarkdownEbookConverter:
         book.spine = ['nav'] + epub_chapters
         
         # 写入EPUB文件
-        epub.write_epub(output_file, book, {})
+        writer = self.epub_writer_class(output_file, book, {})
+        writer.process()
+        writer.write()
+        return has_cover
     
-    def create_epub_with_cover(self, chapters, headings, title, author, output_file, cover_path=None):
-        """创建带封面的EPUB文件
+    def _read_cover(self, cover_path):
+        """在后台线程开始读取封面图片
         
         Args:
-            chapters (list): 章节列表
-            headings (list): 标题列表
-            title (str): 书籍标题
-            author (str): 作者
-            output_file (str): 输出文件路径
-            cover_path (str, optional): 封面图片路径
+            cover_path (str): 封面图片路径，可以为None
+            
+        Returns:
+            Future: 读取结果（图片字节）；没有封面时返回None
         """
-        book = epub.EpubBook()
-        
-        # 设置书籍元数据
-        book.set_identifier('md2epub-web')
-        book.set_title(title)
-        book.set_language('zh-CN')
-        book.add_author(author)
+        if not cover_path:
+            return None
+        return get_io_pool().submit(Path(cover_path).read_bytes)
+    
+    def _add_cover(self, book, cover_path, cover_future):
+        """等待封面读取完成并加入书籍，文件不存在时跳过
         
-        # 添加封面图片
-        if cover_path and os.path.exists(cover_path):
-            with open(cover_path, 'rb') as f:
-                cover_image = f.read()
-            
-            # 确定图片类型
-            ext = cover_path.split('.')[-1].lower()
-            media_type = f"image/{ext}" if ext in ['png', 'gif'] else "image/jpeg"
+        Args:
+            book (epub.EpubBook): 书籍
+            cover_path (str): 封面图片路径
+            cover_future (Future): _read_cover返回的读取结果
             
-            book.set_cover("cover.jpg", cover_image)
-        
-        # CSS样式
-        style = '''
-        body { 
-            font-family: "Microsoft YaHei", "SimSun", serif; 
-            line-height: 1.6;
-            margin: 2em;
-        }
-        h1, h2, h3, h4, h5, h6 { 
-            color: #333; 
-            margin-top: 1.5em;
-            margin-bottom: 0.5em;
-        }
-        h1 { 
-            font-size: 1.8em; 
-            border-bottom: 2px solid #333;
-            padding-bottom: 0.3em;
-        }
-        h2 { 
-            font-size: 1.5em;
-            color: #666;
-        }
-        h3 { 
-            font-size: 1.3em;
-        }
-        p { 
-            margin-bottom: 1em;
-            text-align: justify;
-        }
-        ul, ol {
-            margin-left: 2em;
-        }
-        li {
-            margin-bottom: 0.5em;
-        }
-        strong {
-            font-weight: bold;
-            color: #d73502;
-        }
-        /* 行内代码样式 */
-        code {
-            background-color: #f1f3f4;
-            color: #c7254e;
-            padding: 2px 6px;
-            border-radius: 4px;
-            font-family: "Consolas", "Monaco", "Courier New", monospace;
-            font-size: 0.9em;
-            border: 1px solid #e1e4e8;
-        }
-        /* 代码块样式 */
-        pre {
-            background-color: #f8f9fa;
-            border: 1px solid #e1e4e8;
-            border-radius: 6px;
-            padding: 16px;
-            margin: 16px 0;
-            overflow-x: auto;
-            line-height: 1.45;
-            position: relative;
-        }
-        pre code {
-            background-color: transparent;
-            color: #24292e;
-            padding: 0;
-            border: none;
-            font-family: "Consolas", "Monaco", "Courier New", monospace;
-            font-size: 0.85em;
-            white-space: pre;
-            word-wrap: normal;
-        }
-        /* 代码块语言标签 */
-        .code-lang {
-            position: absolute;
-            top: 8px;
-            right: 12px;
-            font-size: 0.75em;
-            color: #586069;
-            background-color: #ffffff;
-            padding: 2px 6px;
-            border-radius: 3px;
-            border: 1px solid #e1e4e8;
-        }
-        /* 语法高亮 - 关键字 */
-        .highlight .k, .highlight .kd, .highlight .kn, .highlight .kr, .highlight .kt { 
-            color: #d73a49; 
-            font-weight: bold; 
-        }
-        /* 语法高亮 - 字符串 */
-        .highlight .s, .highlight .s1, .highlight .s2, .highlight .sb, .highlight .sc { 
-            color: #032f62; 
-        }
-        /* 语法高亮 - 注释 */
-        .highlight .c, .highlight .c1, .highlight .cm { 
-            color: #6a737d; 
-            font-style: italic; 
-        }
-        /* 语法高亮 - 数字 */
-        .highlight .m, .highlight .mi, .highlight .mf, .highlight .mh, .highlight .mo { 
-            color: #005cc5; 
-        }
-        /* 语法高亮 - 函数名 */
-        .highlight .nf { 
-            color: #6f42c1; 
-            font-weight: bold; 
-        }
-        /* 语法高亮 - 变量 */
-        .highlight .n, .highlight .na, .highlight .nb, .highlight .nc, .highlight .nd, .highlight .ne, .highlight .ni, .highlight .nl, .highlight .nn, .highlight .nt, .highlight .nv, .highlight .nx { 
-            color: #24292e; 
-        }
-        /* 语法高亮 - 操作符 */
-        .highlight .o { 
-            color: #d73a49; 
-        }
-        blockquote {
-            border-left: 4px solid #ddd;
-            margin-left: 0;
-            padding-left: 1em;
-            color: #666;
-        }
-        '''
-        
-        nav_css = epub.EpubItem(uid="nav_css",
-                               file_name="style/nav.css",
-                               media_type="text/css",
-                               content=style)
-        book.add_item(nav_css)
-        
-        # 创建章节
-        epub_chapters = []
+        Returns:
+            bool: 是否加入了封面
+        """
+        if cover_future is None:
+            return False
+        try:
+            cover_image = cover_future.result()
+        except FileNotFoundError:
+            return False
+        
+        # 按实际图片类型命名封面，ebooklib据此写入正确的media-type
+        ext = os.path.splitext(cover_path)[1][1:].lower()
+        book.set_cover(COVER_FILE_NAMES.get(ext, 'cover.jpg'), cover_image)
+        return True
+    
+    def _make_chapter(self, index, chapter):
+        """把一个章节包装为EPUB章节对象（不依赖book，可独立构建）
         
-        for i, chapter in enumerate(chapters):
-            chapter_id = f"chapter_{i}"
-            chapter_file = f"chapter_{i}.xhtml"
-            
-            # 包装HTML内容
-            html_content = f'''<!DOCTYPE html>
-<html xmlns="http://www.w3.org/1999/xhtml">
-<head>
-    <title>{chapter['title']}</title>
-    <link rel="stylesheet" type="text/css" href="style/nav.css"/>
-</head>
-<body>
-{chapter['content']}
-</body>
-</html>'''
-            
-            c = epub.EpubHtml(title=chapter['title'],
-                             file_name=chapter_file,
-                             lang='zh-CN')
-            c.content = html_content
+        Args:
+            index (int): 章节序号
+            chapter (dict): 章节，包含title和content
             
-            book.add_item(c)
-            epub_chapters.append(c)
-        
-        # 生成详细目录结构
-        detailed_toc = self.create_detailed_toc(headings, chapters)
-        book.toc = detailed_toc
-        
-        # 添加导航文件
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
-        
-        # 设置书脊
-        book.spine = ['nav'] + epub_chapters
-        
-        # 写入EPUB文件
-        epub.write_epub(output_file, book, {})
+        Returns:
+            epub.EpubHtml: 章节对象
+        """
+        # 包装HTML内容（直接拼接UTF-8字节，ebooklib无需再编码）
+        html_content = b''.join((XHTML_HEAD, chapter['title'].encode('utf-8'), XHTML_MID,
+                                 chapter['content'].encode('utf-8'), XHTML_TAIL))
+        
+        c = epub.EpubHtml(title=chapter['title'],
+                         file_name=f"chapter_{index}.xhtml",
+                         lang='zh-CN')
+        c.content = html_content
+        return c
 
 
 if __name__ == "__main__":
@@ -654,8 +841,9 @@ if __name__ == "__main__":
 """
     
     html = converter.parse_markdown_content(test_markdown)
-    headings = converter.extract_headings(html)
-    chapters = converter.split_content_by_chapters(html, headings)
+    
+    # 只解析和遍历一次，同时得到标题和章节
+    headings, chapters = converter._parse_and_split(html)
     
     print(f"找到 {len(headings)} 个标题")
     print(f"分割为 {len(chapters)} 个章节")
@@ -6,7 +6,23 @@
 
 import os
 import sys
-from app import app
+import importlib.util
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_gunicorn():
+    """用gunicorn替换当前进程（多个worker进程，CPU密集的转换可以并行）
+
+    绑定地址和worker数由gunicorn_conf.py从环境变量读取
+    """
+    os.execvp(sys.executable, [
+        sys.executable, '-m', 'gunicorn',
+        '--chdir', BASE_DIR,
+        '-c', os.path.join(BASE_DIR, 'gunicorn_conf.py'),
+        'wsgi:application'
+    ])
+
 
 if __name__ == '__main__':
     print("=" * 60)
@@ -22,6 +38,12 @@ if __name__ == '__main__':
     host = os.environ.get('HOST', '0.0.0.0')
     debug = os.environ.get('DEBUG', 'True').lower() == 'true'
     
+    # 非调试模式使用gunicorn；Windows不支持gunicorn，未安装时也回退到Flask内置服务器
+    if not debug and os.name != 'nt' and importlib.util.find_spec('gunicorn') is not None:
+        run_gunicorn()
+    
+    from app import app
+    
     try:
         app.run(
             host=host,
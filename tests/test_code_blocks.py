@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代码块处理的回归测试：字符串处理路径与BeautifulSoup回退路径应得到相同的结果
+"""
+
+import os
+import sys
+import unittest
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from md2ebook import MarkdownEbookConverter
+
+
+def normalize(html):
+    """用html.parser重新序列化，抹平引号等写法上的差异"""
+    return str(BeautifulSoup(html, 'html.parser'))
+
+
+class CodeBlockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.converter = MarkdownEbookConverter()
+
+    def assertPathsAgree(self, html):
+        """字符串路径（若能处理）与回退路径的结果一致，返回最终结果"""
+        text = self.converter._process_code_blocks_text(html)
+        soup = self.converter._process_code_blocks_soup(html)
+        if text is not None:
+            self.assertEqual(normalize(text), normalize(soup))
+        return self.converter._process_code_blocks(html)
+
+    def test_unquoted_class(self):
+        result = self.assertPathsAgree('<pre class=x><code class=language-rust>fn main() {}</code></pre>')
+        pre = BeautifulSoup(result, 'html.parser').pre
+        self.assertEqual(pre['class'], ['x', 'highlight'])
+        self.assertEqual(pre.span.string, 'RUST')
+        self.assertEqual(result.count('class=', 0, result.index('>')), 1)
+
+    def test_quoted_class(self):
+        result = self.assertPathsAgree("<pre CLASS='a b'><code class=\"language-go\">x</code></pre>")
+        pre = BeautifulSoup(result, 'html.parser').pre
+        self.assertEqual(pre['class'], ['a', 'b', 'highlight'])
+        self.assertEqual(pre.span.string, 'GO')
+
+    def test_unparsed_class_falls_back(self):
+        for html in ['<pre class=><code>x</code></pre>',
+                     '<pre class=a class=b><code>x</code></pre>']:
+            self.assertIsNone(self.converter._process_code_blocks_text(html))
+
+    def test_code_block_inside_comment_untouched(self):
+        html = ('<!-- <pre><code class="language-py">x</code></pre> -->\n'
+                '<pre><code>SELECT 1</code></pre>')
+        result = self.assertPathsAgree(html)
+        self.assertTrue(result.startswith('<!-- <pre><code class="language-py">x</code></pre> -->'))
+        self.assertEqual(result.count('code-lang'), 1)
+
+    def test_leading_comment_and_style_kept(self):
+        html = self.converter.parse_markdown_content(
+            '<!-- note -->\n\n<style>p{color:red}</style>\n\n# H\n\n```\nx=1\n```')
+        self.assertTrue(html.startswith('<!-- note -->\n<style>p{color:red}</style>\n<h1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WSGI入口：供 gunicorn 等 WSGI 服务器加载
+
+    gunicorn -c gunicorn_conf.py wsgi:application
+"""
+
+from app import app
+
+application = app